@@ -49,6 +49,8 @@ es_client = get_es_client()
 TRANSLATION_STORE = TranslationStore()
 TRANSLATION_STORE.load()
 
+INSIGHT_TYPE_NAMES = frozenset(t.name for t in InsightType)
+
 
 class ProductInsightResource:
     def on_get(self, req: falcon.Request, resp: falcon.Response, barcode: str):
@@ -321,7 +323,7 @@ class InsightImporterResource:
         insight_type = req.get_param("type", required=True)
         server_domain = req.get_param("server_domain", required=True)
 
-        if insight_type not in (t.name for t in InsightType):
+        if insight_type not in INSIGHT_TYPE_NAMES:
             raise falcon.HTTPBadRequest(
                 description="unknown insight type: " "'{}'".format(insight_type)
             )
@@ -2,7 +2,7 @@ from typing import Union, Optional, List, Iterable
 
 from robotoff import settings
 from robotoff.insights.annotate import (
-    InsightAnnotatorFactory,
+    get_annotator,
     AnnotationResult,
     ALREADY_ANNOTATED_RESULT,
     UNKNOWN_INSIGHT_RESULT,
@@ -103,5 +103,5 @@ def save_insight(
     if insight.annotation is not None:
         return ALREADY_ANNOTATED_RESULT
 
-    annotator = InsightAnnotatorFactory.get(insight.type)
+    annotator = get_annotator(insight.type)
     return annotator.annotate(insight, annotation, update, auth=auth)
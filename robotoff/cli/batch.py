@@ -1,7 +1,9 @@
 import ast
 from typing import Dict, Optional
 
-from robotoff.insights.annotate import InsightAnnotatorFactory
+from more_itertools import chunked
+
+from robotoff.insights.annotate import annotate_batch, find_annotator
 from robotoff.models import ProductInsight
 
 
@@ -17,7 +19,8 @@ def run(insight_type: str, dry: bool = True, json_contains_str: Optional[str] =
 def batch_annotate(
     insight_type: str, dry: bool = True, json_contains: Optional[Dict] = None
 ):
-    annotator = InsightAnnotatorFactory.get(insight_type)
+    # fail early on unknown insight types
+    find_annotator(insight_type)
 
     i = 0
 
@@ -42,13 +45,14 @@ def batch_annotate(
             "".format(count, insight_type, json_contains)
         )
     else:
-        for insight in query:
-            i += 1
-            print("Insight %d" % i)
-            print(
-                "Add label {} to https://fr.openfoodfacts.org/produit/{}"
-                "".format(insight.data, insight.barcode)
-            )
-            print(insight.data)
-
-            annotator.annotate(insight, 1, update=True)
+        for insight_batch in chunked(query.iterator(), 100):
+            for insight in insight_batch:
+                i += 1
+                print("Insight %d" % i)
+                print(
+                    "Add label {} to https://fr.openfoodfacts.org/produit/{}"
+                    "".format(insight.data, insight.barcode)
+                )
+                print(insight.data)
+
+            annotate_batch(insight_batch, 1, update=True)
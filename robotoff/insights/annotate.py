@@ -1,10 +1,26 @@
 import abc
-import datetime
-from typing import Optional, List
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
-from dataclasses import dataclass
 from enum import Enum
 
+from peewee import Case
+
 from robotoff.insights._enum import InsightType
 from robotoff.insights.normalize import normalize_emb_code
 from robotoff.models import db, ProductInsight, UserAnnotation
@@ -25,9 +41,15 @@ from robotoff.utils.types import JSONType
 
 logger = get_logger(__name__)
 
+# Threads used to send product updates to OFF while the annotation is being
+# saved in DB
+_product_update_executor = ThreadPoolExecutor(max_workers=8)
+
+# Number of products fetched concurrently by batch annotation
+_PRODUCT_FETCH_WORKERS = 8
 
-@dataclass
-class AnnotationResult:
+
+class AnnotationResult(NamedTuple):
     status: str
     description: Optional[str] = None
 
@@ -61,20 +83,82 @@ UNKNOWN_INSIGHT_RESULT = AnnotationResult(
 )
 
 
+# Insight data key of the snapshot of the OFF product fields taken when the
+# insight was created, and duration (in seconds) during which the snapshot is
+# used instead of fetching the product from OFF again.
+PRODUCT_SNAPSHOT_KEY = "_product_snapshot"
+PRODUCT_SNAPSHOT_TTL = 60
+
+
+def create_product_snapshot(insight_type: str, product: JSONType) -> Optional[JSONType]:
+    """Return a snapshot of the product field read by the annotator of
+    `insight_type`, to be stored in the insight data under
+    `PRODUCT_SNAPSHOT_KEY`, or None if no snapshot can be used for this
+    insight type."""
+    annotator = ANNOTATORS.get(insight_type)
+
+    # annotators overwriting the field always read the current product
+    if annotator is None or annotator.replaces_field:
+        return None
+
+    return {
+        "fields": {annotator.field: product.get(annotator.field)},
+        "fetched_at": time.time(),
+    }
+
+
+def get_product_snapshot(insight: ProductInsight, field: str) -> Optional[JSONType]:
+    """Return the product snapshot stored in the insight data if it contains
+    `field` and is still fresh, None otherwise."""
+    snapshot = (insight.data or {}).get(PRODUCT_SNAPSHOT_KEY)
+
+    if (
+        snapshot is None
+        or field not in snapshot["fields"]
+        or time.time() - snapshot["fetched_at"] > PRODUCT_SNAPSHOT_TTL
+    ):
+        return None
+
+    return dict(snapshot["fields"])
+
+
+def delete_stale_product_snapshots() -> int:
+    """Remove product snapshots that are too old to be used from the insight
+    data, return the number of updated insights."""
+    with db:
+        with db.atomic():
+            return (
+                ProductInsight.update(
+                    data=ProductInsight.data.remove(PRODUCT_SNAPSHOT_KEY)
+                )
+                .where(
+                    ProductInsight.data.has_key(PRODUCT_SNAPSHOT_KEY),
+                    ProductInsight.timestamp
+                    < datetime.utcnow() - timedelta(seconds=PRODUCT_SNAPSHOT_TTL),
+                )
+                .execute()
+            )
+
+
 def extract_username(session_cookie: str) -> Optional[str]:
-    splitted = session_cookie.split("&")
+    # the username is the item following the "user_id" item in the
+    # '&'-separated session cookie
+    key = "user_id&"
 
-    if splitted:
-        is_next = False
-        for split in splitted:
-            if split == "user_id":
-                is_next = True
-                continue
-            elif is_next:
-                if split:
-                    return split
-                else:
-                    break
+    if session_cookie.startswith(key):
+        start = len(key)
+    else:
+        start = session_cookie.find("&" + key)
+
+        if start != -1:
+            start += len(key) + 1
+
+    if start != -1:
+        end = session_cookie.find("&", start)
+        username = session_cookie[start:] if end == -1 else session_cookie[start:end]
+
+        if username:
+            return username
 
     logger.warning(
         "Unable to extract username from session cookie: {}".format(session_cookie)
@@ -82,14 +166,176 @@ def extract_username(session_cookie: str) -> Optional[str]:
     return None
 
 
+class BatchAnnotationWriter:
+    """Buffer annotation DB writes, to save them in a single transaction.
+
+    Insight updates and user annotations are written when `flush` is called,
+    or when an item is enqueued and the buffer is full or, if `max_delay` is
+    set, its oldest item was enqueued more than `max_delay` seconds ago. The
+    writer can be used as a context manager, the buffer being flushed on exit.
+    """
+
+    def __init__(self, max_size: int = 500, max_delay: Optional[float] = None):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # (annotation, completion date, username) by insight ID, an insight
+        # enqueued twice is only written once, with its last annotation
+        self._buffer: Dict[Any, Tuple[int, datetime, Optional[str]]] = {}
+        self._buffer_start: float = 0.0
+        self._lock = threading.Lock()
+
+    def enqueue(
+        self,
+        insight_id,
+        username: Optional[str],
+        annotation: int,
+        completed_at: Optional[datetime] = None,
+    ):
+        with self._lock:
+            if not self._buffer:
+                self._buffer_start = time.monotonic()
+
+            self._buffer[insight_id] = (
+                annotation,
+                completed_at or datetime.utcnow(),
+                username,
+            )
+            should_flush = len(self._buffer) >= self.max_size or (
+                self.max_delay is not None
+                and time.monotonic() - self._buffer_start >= self.max_delay
+            )
+
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write the buffered annotations, return the number of insights
+        updated.
+
+        If the write fails, the annotations are put back in the buffer."""
+        with self._lock:
+            rows, self._buffer = self._buffer, {}
+
+        if not rows:
+            return 0
+
+        try:
+            with db.atomic():
+                for query in self.build_queries(rows):
+                    query.execute()
+        except BaseException:
+            with self._lock:
+                # annotations enqueued in the meantime are more recent
+                self._buffer = {**rows, **self._buffer}
+                self._buffer_start = time.monotonic()
+            raise
+
+        return len(rows)
+
+    @staticmethod
+    def build_queries(rows: Dict[Any, Tuple[int, datetime, Optional[str]]]) -> List:
+        """Return the queries saving the annotations `rows`, keyed by insight
+        ID."""
+        queries = [
+            ProductInsight.update(
+                annotation=Case(
+                    None,
+                    [
+                        (ProductInsight.id == insight_id, annotation)
+                        for insight_id, (annotation, _, _) in rows.items()
+                    ],
+                ),
+                completed_at=Case(
+                    None,
+                    [
+                        (ProductInsight.id == insight_id, completed_at)
+                        for insight_id, (_, completed_at, _) in rows.items()
+                    ],
+                ),
+            ).where(ProductInsight.id.in_(list(rows)))
+        ]
+        user_annotations = [
+            {"insight": insight_id, "username": username}
+            for insight_id, (_, _, username) in rows.items()
+            if username
+        ]
+
+        if user_annotations:
+            queries.append(UserAnnotation.insert_many(user_annotations))
+
+        return queries
+
+    def __enter__(self) -> "BatchAnnotationWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+class InFlightRequests:
+    """Coalesce concurrent calls sharing the same key: while a call is in
+    progress, other callers with the same key wait for it and get its
+    result instead of performing the call again."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: Dict[Tuple, Future] = {}
+
+    def run(self, key: Tuple, func: Callable, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+
+            if future is None:
+                future = self._futures[key] = Future()
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+
+# Product updates currently sent to OFF, keyed by (server domain, barcode,
+# product field, insight value, user credentials)
+_in_flight_updates = InFlightRequests()
+
+
 class InsightAnnotator(metaclass=abc.ABCMeta):
+    # product field read before updating the product on OFF
+    field: str
+    # whether the update overwrites the field: the product must then be read
+    # from OFF, not from the get_product cache, to avoid losing concurrent
+    # edits
+    replaces_field: bool = False
+
     def annotate(
         self,
         insight: ProductInsight,
         annotation: int,
         update=True,
         auth: Optional[OFFAuthentication] = None,
+        product: Optional[JSONType] = None,
+        writer: Optional[BatchAnnotationWriter] = None,
     ) -> AnnotationResult:
+        """Annotate the insight, and update the product on OFF if the insight
+        was validated and `update` is True.
+
+        If `writer` is provided, the annotation is enqueued in the writer
+        instead of being saved immediately: the OFF update is then sent before
+        the annotation is written in DB. If the write fails, the insight stays
+        unannotated and is annotated again later, the product being then
+        considered as already annotated.
+        """
         username: Optional[str] = None
         if auth is not None:
             username = auth.username
@@ -97,47 +343,139 @@ class InsightAnnotator(metaclass=abc.ABCMeta):
             if auth.session_cookie:
                 username = extract_username(auth.session_cookie)
 
-        with db.atomic():
-            insight.annotation = annotation
-            insight.completed_at = datetime.datetime.utcnow()
-            insight.save()
+        send_update = annotation == 1 and update
+        insight.annotation = annotation
+        insight.completed_at = datetime.utcnow()
+
+        if writer is not None:
+            writer.enqueue(insight.id, username, annotation, insight.completed_at)
+
+            if send_update:
+                return self._send_update(insight, auth, product)
+
+            return SAVED_ANNOTATION_RESULT
+
+        update_future: Optional[Future] = None
+        try:
+            with db.atomic():
+                # only update the annotation fields instead of saving the row
+                ProductInsight.update(
+                    annotation=insight.annotation, completed_at=insight.completed_at
+                ).where(ProductInsight.id == insight.id).execute()
+
+                if send_update:
+                    # The insight is saved: send the OFF update while the user
+                    # annotation is being saved.
+                    update_future = _product_update_executor.submit(
+                        self._send_update, insight, auth, product
+                    )
+
+                if username:
+                    UserAnnotation.insert(
+                        insight=insight.id, username=username
+                    ).execute()
+        except BaseException:
+            if update_future is not None and not update_future.cancel():
+                # the OFF update is already in progress, wait for it to end
+                # before reporting the DB error
+                exc = update_future.exception()
+
+                if exc is not None:
+                    logger.warning("Error during product update", exc_info=exc)
+            raise
+
+        if update_future is not None:
+            return update_future.result()
 
-            if username:
-                UserAnnotation.create(insight=insight, username=username)
+        return SAVED_ANNOTATION_RESULT
 
-        if annotation == 1 and update:
-            return self.update_product(insight, auth=auth)
+    def _send_update(
+        self,
+        insight: ProductInsight,
+        auth: Optional[OFFAuthentication],
+        product: Optional[JSONType],
+    ) -> AnnotationResult:
+        # Identical updates of the same product by the same user are sent only
+        # once.
+        auth_key: Optional[Tuple] = None
+        if auth is not None:
+            auth_key = (auth.session_cookie, auth.username, auth.password)
 
-        return SAVED_ANNOTATION_RESULT
+        update_key = (
+            insight.server_domain,
+            insight.barcode,
+            self.field,
+            insight.value_tag,
+            insight.value,
+            auth_key,
+        )
+        return _in_flight_updates.run(
+            update_key, self.update_product, insight, auth=auth, product=product
+        )
+
+    def fetch_product(self, insight: ProductInsight) -> Optional[JSONType]:
+        """Return the product fields needed by the annotator, from the fresh
+        product snapshot of the insight if available, from OFF otherwise."""
+        product: Optional[JSONType] = None
+
+        if not self.replaces_field:
+            product = get_product_snapshot(insight, self.field)
+
+        if product is None:
+            product = get_product(
+                insight.barcode, [self.field], use_cache=not self.replaces_field
+            )
+
+        return product
 
     @abc.abstractmethod
     def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
+        self,
+        insight: ProductInsight,
+        auth: Optional[OFFAuthentication] = None,
+        product: Optional[JSONType] = None,
     ) -> AnnotationResult:
+        """Update the product on OFF.
+
+        If `product` is provided, it is used instead of calling
+        `fetch_product`. It must contain the field required by the annotator,
+        and it is updated in place so that it can be shared between the
+        insights of the same product.
+        """
         pass
 
 
 class PackagerCodeAnnotator(InsightAnnotator):
+    field = "emb_codes"
+    replaces_field = True
+
     def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
+        self,
+        insight: ProductInsight,
+        auth: Optional[OFFAuthentication] = None,
+        product: Optional[JSONType] = None,
     ) -> AnnotationResult:
         emb_code: str = insight.value
 
-        product = get_product(insight.barcode, ["emb_codes"])
+        if product is None:
+            product = self.fetch_product(insight)
 
         if product is None:
             return MISSING_PRODUCT_RESULT
 
         emb_codes_str: str = product.get("emb_codes", "")
 
-        emb_codes: List[str] = []
-        if emb_codes_str:
+        if not emb_codes_str:
+            emb_codes = [emb_code]
+        else:
             emb_codes = emb_codes_str.split(",")
 
-        if self.already_exists(emb_code, emb_codes):
-            return ALREADY_ANNOTATED_RESULT
+            if self.already_exists(emb_code, emb_codes):
+                return ALREADY_ANNOTATED_RESULT
+
+            emb_codes.append(emb_code)
 
-        emb_codes.append(emb_code)
+        product["emb_codes"] = ",".join(emb_codes)
         update_emb_codes(
             insight.barcode,
             emb_codes,
@@ -149,128 +487,71 @@ class PackagerCodeAnnotator(InsightAnnotator):
 
     @staticmethod
     def already_exists(new_emb_code: str, emb_codes: List[str]) -> bool:
-        emb_codes = [normalize_emb_code(emb_code) for emb_code in emb_codes]
-
         normalized_emb_code = normalize_emb_code(new_emb_code)
-
-        if normalized_emb_code in emb_codes:
-            return True
-
-        return False
-
-
-class LabelAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["labels_tags"])
-
-        if product is None:
-            return MISSING_PRODUCT_RESULT
-
-        labels_tags: List[str] = product.get("labels_tags") or []
-
-        if insight.value_tag in labels_tags:
-            return ALREADY_ANNOTATED_RESULT
-
-        add_label_tag(
-            insight.barcode,
-            insight.value_tag,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
+        return any(
+            normalize_emb_code(emb_code) == normalized_emb_code
+            for emb_code in emb_codes
         )
 
-        return UPDATED_ANNOTATION_RESULT
-
 
-class CategoryAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["categories_tags"])
-
-        if product is None:
-            return MISSING_PRODUCT_RESULT
-
-        categories_tags: List[str] = product.get("categories_tags") or []
-
-        if insight.value_tag in categories_tags:
-            return ALREADY_ANNOTATED_RESULT
-
-        category_tag = insight.value_tag
-        add_category(
-            insight.barcode,
-            category_tag,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
-        )
+class ProductFieldAnnotator(InsightAnnotator):
+    """Generic annotator, sending the insight value to OFF with `update_func`.
 
-        return UPDATED_ANNOTATION_RESULT
+    `check` defines when the product is considered as already annotated:
+    - "tag": the insight value tag is in the product `field` tag list
+    - "filled": the product `field` is not empty
+    - None: never
+    """
 
+    def __init__(
+        self,
+        field: str,
+        update_func: Callable,
+        value_attr: str = "value",
+        check: Optional[str] = "tag",
+    ):
+        self.field = field
+        self.update_func = update_func
+        self.value_attr = value_attr
+        self.check = check
+        self.replaces_field = check == "filled"
 
-class ProductWeightAnnotator(InsightAnnotator):
     def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
+        self,
+        insight: ProductInsight,
+        auth: Optional[OFFAuthentication] = None,
+        product: Optional[JSONType] = None,
     ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["quantity"])
-
         if product is None:
-            return MISSING_PRODUCT_RESULT
-
-        quantity: Optional[str] = product.get("quantity") or None
-
-        if quantity is not None:
-            return ALREADY_ANNOTATED_RESULT
-
-        update_quantity(
-            insight.barcode,
-            insight.value,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
-        )
-
-        return UPDATED_ANNOTATION_RESULT
-
-
-class ExpirationDateAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["expiration_date"])
+            product = self.fetch_product(insight)
 
         if product is None:
             return MISSING_PRODUCT_RESULT
 
-        current_expiration_date = product.get("expiration_date") or None
+        value: str = getattr(insight, self.value_attr)
 
-        if current_expiration_date:
-            return ALREADY_ANNOTATED_RESULT
+        if self.check == "tag":
+            tags = product.get(self.field)
 
-        update_expiration_date(
-            insight.barcode,
-            insight.value,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
-        )
-        return UPDATED_ANNOTATION_RESULT
+            # Tags are stored back as a frozenset, so that it is only built
+            # once when the product is shared between several insights.
+            if not isinstance(tags, frozenset):
+                tags = product[self.field] = frozenset(tags or ())
 
+            if insight.value_tag in tags:
+                return ALREADY_ANNOTATED_RESULT
 
-class BrandAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["brands_tags"])
+            product[self.field] = tags | {insight.value_tag}
 
-        if product is None:
-            return MISSING_PRODUCT_RESULT
+        elif self.check == "filled":
+            if product.get(self.field):
+                return ALREADY_ANNOTATED_RESULT
+
+            product[self.field] = value
 
-        add_brand(
+        self.update_func(
             insight.barcode,
-            insight.value,
+            value,
             insight_id=insight.id,
             server_domain=insight.server_domain,
             auth=auth,
@@ -278,71 +559,174 @@ class BrandAnnotator(InsightAnnotator):
         return UPDATED_ANNOTATION_RESULT
 
 
-class StoreAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        product = get_product(insight.barcode, ["stores_tags"])
+# (product field, OFF update function, insight attribute sent to OFF, check)
+_PRODUCT_FIELD_ANNOTATOR_SPECS: Dict[str, Tuple[str, Callable, str, Optional[str]]] = {
+    InsightType.label.name: ("labels_tags", add_label_tag, "value_tag", "tag"),
+    InsightType.category.name: ("categories_tags", add_category, "value_tag", "tag"),
+    InsightType.product_weight.name: ("quantity", update_quantity, "value", "filled"),
+    InsightType.expiration_date.name: (
+        "expiration_date",
+        update_expiration_date,
+        "value",
+        "filled",
+    ),
+    InsightType.brand.name: ("brands_tags", add_brand, "value", None),
+    InsightType.store.name: ("stores_tags", add_store, "value", "tag"),
+    InsightType.packaging.name: ("packaging_tags", add_packaging, "value", "tag"),
+}
+
+
+ANNOTATORS: Mapping[str, InsightAnnotator] = MappingProxyType(
+    {
+        InsightType.packager_code.name: PackagerCodeAnnotator(),
+        **{
+            insight_type: ProductFieldAnnotator(*spec)
+            for insight_type, spec in _PRODUCT_FIELD_ANNOTATOR_SPECS.items()
+        },
+    }
+)
 
-        if product is None:
-            return MISSING_PRODUCT_RESULT
+# Return the annotator of an insight type, raise a KeyError if the insight
+# type has no annotator
+get_annotator: Callable[[str], InsightAnnotator] = ANNOTATORS.__getitem__
 
-        stores_tags: List[str] = product.get("stores_tags") or []
 
-        if insight.value_tag in stores_tags:
-            return ALREADY_ANNOTATED_RESULT
+def find_annotator(insight_type: str) -> InsightAnnotator:
+    """Return the annotator of an insight type provided by the user, raise a
+    ValueError if the insight type has no annotator."""
+    try:
+        return ANNOTATORS[insight_type]
+    except KeyError:
+        raise ValueError("unknown annotator: {}".format(insight_type))
 
-        add_store(
-            insight.barcode,
-            insight.value,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
-        )
-        return UPDATED_ANNOTATION_RESULT
 
+def _fetch_batch_product(
+    barcode: str, annotators: List[InsightAnnotator]
+) -> Optional[JSONType]:
+    """Fetch the product fields needed by all `annotators`."""
+    return get_product(
+        barcode,
+        sorted({annotator.field for annotator in annotators}),
+        use_cache=not any(annotator.replaces_field for annotator in annotators),
+    )
 
-class PackagingAnnotator(InsightAnnotator):
-    def update_product(
-        self, insight: ProductInsight, auth: Optional[OFFAuthentication] = None
-    ) -> AnnotationResult:
-        packaging_tag: str = insight.value_tag
 
-        product = get_product(insight.barcode, ["packaging_tags"])
+def _get_batch_product_snapshot(
+    insights: List[ProductInsight], annotators: List[InsightAnnotator]
+) -> Optional[JSONType]:
+    """Return the product fields needed by all `annotators` from the fresh
+    product snapshots of `insights`, None if a field is not available."""
+    product: JSONType = {}
+
+    for insight, annotator in zip(insights, annotators):
+        if annotator.field in product:
+            continue
+
+        snapshot = get_product_snapshot(insight, annotator.field)
+
+        if snapshot is None:
+            return None
+
+        product.update(snapshot)
+
+    return product
+
+
+def annotate_batch(
+    insights: Iterable[ProductInsight],
+    annotation: int = 1,
+    update: bool = True,
+    auth: Optional[OFFAuthentication] = None,
+) -> List[AnnotationResult]:
+    """Annotate a batch of insights, fetching each product from OFF only
+    once.
+
+    Insights are grouped by barcode, and a single `get_product` call
+    requesting the fields needed by all annotators of the group is performed.
+    Products only updated by additive annotators are read from the fresh
+    product snapshots of the insights if available, or fetched concurrently
+    before the first update; products with an annotator overwriting a field
+    are fetched right before being updated, so that edits made on OFF in the
+    meantime are not lost. Annotations are saved in DB by batch.
+    Results are returned in the same order as `insights`.
+    """
+    insights = list(insights)
+    by_barcode: Dict[str, List[int]] = defaultdict(list)
+
+    for i, insight in enumerate(insights):
+        by_barcode[insight.barcode].append(i)
+
+    results: List[Optional[AnnotationResult]] = [None] * len(insights)
+    fetch = annotation == 1 and update
+    annotators: Dict[str, List[InsightAnnotator]] = {
+        barcode: [get_annotator(insights[i].type) for i in indices]
+        for barcode, indices in by_barcode.items()
+    }
+    products: Dict[str, Optional[JSONType]] = {}
 
-        if product is None:
-            return MISSING_PRODUCT_RESULT
+    if fetch:
+        to_fetch: List[str] = []
 
-        packaging_tags: List[str] = product.get("packaging_tags") or []
+        for barcode, barcode_annotators in annotators.items():
+            if any(annotator.replaces_field for annotator in barcode_annotators):
+                continue
 
-        if packaging_tag in packaging_tags:
-            return ALREADY_ANNOTATED_RESULT
+            product = _get_batch_product_snapshot(
+                [insights[i] for i in by_barcode[barcode]], barcode_annotators
+            )
+
+            if product is None:
+                to_fetch.append(barcode)
+            else:
+                products[barcode] = product
+
+        # products are fetched concurrently, reusing the pooled
+        # connections of the OFF HTTP session
+        with ThreadPoolExecutor(max_workers=_PRODUCT_FETCH_WORKERS) as executor:
+            futures = {
+                barcode: executor.submit(
+                    _fetch_batch_product, barcode, annotators[barcode]
+                )
+                for barcode in to_fetch
+            }
+            products.update(
+                (barcode, future.result()) for barcode, future in futures.items()
+            )
+
+    with BatchAnnotationWriter() as writer:
+        for barcode, indices in by_barcode.items():
+            if fetch and barcode not in products:
+                products[barcode] = _fetch_batch_product(barcode, annotators[barcode])
+
+            product = products.get(barcode)
+
+            for i, annotator in zip(indices, annotators[barcode]):
+                insight = insights[i]
+
+                if fetch and product is None:
+                    # the annotation is saved, as in the single insight case
+                    annotator.annotate(
+                        insight, annotation, update=False, auth=auth, writer=writer
+                    )
+                    results[i] = MISSING_PRODUCT_RESULT
+                else:
+                    results[i] = annotator.annotate(
+                        insight,
+                        annotation,
+                        update,
+                        auth=auth,
+                        product=product,
+                        writer=writer,
+                    )
 
-        add_packaging(
-            insight.barcode,
-            insight.value,
-            insight_id=insight.id,
-            server_domain=insight.server_domain,
-            auth=auth,
-        )
-        return UPDATED_ANNOTATION_RESULT
+    return results  # type: ignore
 
 
 class InsightAnnotatorFactory:
-    mapping = {
-        InsightType.packager_code.name: PackagerCodeAnnotator(),
-        InsightType.label.name: LabelAnnotator(),
-        InsightType.category.name: CategoryAnnotator(),
-        InsightType.product_weight.name: ProductWeightAnnotator(),
-        InsightType.expiration_date.name: ExpirationDateAnnotator(),
-        InsightType.brand.name: BrandAnnotator(),
-        InsightType.store.name: StoreAnnotator(),
-        InsightType.packaging.name: PackagingAnnotator(),
-    }
+    """Deprecated, use `get_annotator` and `annotate_batch` instead."""
+
+    mapping = ANNOTATORS
 
-    @classmethod
-    def get(cls, identifier: str) -> InsightAnnotator:
-        if identifier not in cls.mapping:
-            raise ValueError("unknown annotator: {}".format(identifier))
+    get = staticmethod(find_annotator)
 
-        return cls.mapping[identifier]
+    annotate_batch = staticmethod(annotate_batch)
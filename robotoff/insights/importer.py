@@ -6,6 +6,7 @@ from typing import Dict, Iterable, List, Set, Optional, Callable, Tuple
 
 from robotoff.brands import BRAND_PREFIX_STORE, in_barcode_range, BRAND_BLACKLIST_STORE
 from robotoff.insights._enum import InsightType
+from robotoff.insights.annotate import create_product_snapshot, PRODUCT_SNAPSHOT_KEY
 from robotoff.insights.data import AUTHORIZED_LABELS
 from robotoff.insights.normalize import normalize_emb_code
 from robotoff.models import batch_insert, ProductInsight
@@ -38,11 +39,22 @@ class InsightImporter(metaclass=abc.ABCMeta):
         self.product_store: ProductStore = product_store
 
     def import_insights(
-        self, data: Iterable[JSONType], server_domain: str, automatic: bool
+        self,
+        data: Iterable[JSONType],
+        server_domain: str,
+        automatic: bool,
+        products: Optional[Dict[str, JSONType]] = None,
     ) -> int:
+        """Import insights in DB.
+
+        `products` optionally maps barcodes to products just fetched from
+        OFF: a snapshot of the product is then stored with the insight, so
+        that the product is not fetched again if the insight is annotated
+        shortly after.
+        """
         timestamp = datetime.datetime.utcnow()
         insights = self.process_insights(data, server_domain, automatic)
-        insights = self.add_fields(insights, timestamp, server_domain)
+        insights = self.add_fields(insights, timestamp, server_domain, products)
         return batch_insert(ProductInsight, insights, 50)
 
     @abc.abstractmethod
@@ -56,12 +68,23 @@ class InsightImporter(metaclass=abc.ABCMeta):
         insights: Iterable[JSONType],
         timestamp: datetime.datetime,
         server_domain: str,
+        products: Optional[Dict[str, JSONType]] = None,
     ) -> Iterable[JSONType]:
         """Add mandatory insight fields."""
         server_type: str = get_server_type(server_domain).name
+        products = products or {}
 
         for insight in insights:
             barcode = insight["barcode"]
+
+            if barcode in products:
+                product_snapshot = create_product_snapshot(
+                    self.get_type(), products[barcode]
+                )
+
+                if product_snapshot is not None:
+                    insight["data"][PRODUCT_SNAPSHOT_KEY] = product_snapshot
+
             product = self.product_store[barcode]
             insight["reserved_barcode"] = is_reserved_barcode(barcode)
             insight["server_domain"] = server_domain
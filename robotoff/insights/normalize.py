@@ -1,6 +1,9 @@
+import functools
+
 from robotoff.utils.text import strip_accents_ascii
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize_emb_code(emb_code: str):
     emb_code = (
         emb_code.strip().lower().replace(" ", "").replace("-", "").replace(".", "")
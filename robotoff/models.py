@@ -34,6 +34,11 @@ def batch_insert(model_cls, data: Iterable[Dict], batch_size=100) -> int:
     return rows
 
 
+def get_public_data(data: JSONType) -> JSONType:
+    """Return the insight data without internal keys (starting with "_")."""
+    return {k: v for k, v in data.items() if not k.startswith("_")}
+
+
 class BaseModel(peewee.Model):
     class Meta:
         database = db
@@ -74,7 +79,7 @@ class ProductInsight(BaseModel):
                 "id": str(self.id),
                 "barcode": self.barcode,
                 "type": self.type,
-                "data": self.data,
+                "data": get_public_data(self.data),
                 "timestamp": self.timestamp.isoformat() if self.timestamp else None,
                 "completed_at": self.completed_at.isoformat()
                 if self.completed_at
@@ -99,7 +104,7 @@ class ProductInsight(BaseModel):
                 "type": self.type,
                 "barcode": self.barcode,
                 "countries": self.countries,
-                **self.data,
+                **get_public_data(self.data),
             }
 
 
@@ -1,14 +1,20 @@
 import enum
 import re
+import threading
 from typing import List, Dict, Optional, Tuple, Union
 
 import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from robotoff import settings
 from robotoff.utils import get_logger
 
 
 class OFFAuthentication:
+    __slots__ = ("session_cookie", "username", "password")
+
     def __init__(
         self,
         session_cookie: Optional[str] = None,
@@ -38,6 +44,18 @@ USER_AGENT_HEADERS = {
 }
 http_session.headers.update(USER_AGENT_HEADERS)
 
+# Keep connections to OFF servers alive and reuse them across calls, to avoid
+# paying a TCP + TLS handshake for every API request.
+# OFF product edits and moves are sent as GET requests: only connection errors
+# are retried, a request that may have reached the server is never resent.
+http_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.1),
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
 AUTH = ("roboto-app", settings.OFF_PASSWORD)
 AUTH_DICT = {
     "user_id": AUTH[0],
@@ -132,16 +150,67 @@ def is_valid_image(barcode: str, image_id: str) -> bool:
     return image_id in images
 
 
+# Short-lived cache of get_product results: {barcode: {(fields, server): product}}.
+# Entries of a barcode expire together, and are invalidated at once as soon as
+# the product is updated by Robotoff.
+_product_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+_product_cache_lock = threading.Lock()
+
+
 def get_product(
     barcode: str,
     fields: List[str] = None,
     server: Optional[Union[ServerType, str]] = None,
+    use_cache: bool = True,
 ) -> Optional[Dict]:
     fields = fields or []
 
     if server is None:
         server = ServerType.off
 
+    cache_key = (tuple(sorted(fields)), server)
+
+    if use_cache:
+        with _product_cache_lock:
+            cached = _product_cache.get(barcode, {}).get(cache_key)
+
+        if cached is not None:
+            # return a copy, callers are allowed to update the product
+            return dict(cached)
+
+    product = _fetch_product(barcode, fields, server)
+
+    if product is not None:
+        with _product_cache_lock:
+            product_entries = _product_cache.get(barcode)
+
+            if product_entries is None:
+                product_entries = _product_cache[barcode] = {}
+
+            product_entries[cache_key] = product
+
+        return dict(product)
+
+    return None
+
+
+def invalidate_product_cache(barcode: str):
+    """Remove all cached get_product results of the product."""
+    with _product_cache_lock:
+        _product_cache.pop(barcode, None)
+
+
+def clear_product_cache():
+    with _product_cache_lock:
+        _product_cache.clear()
+
+
+get_product.cache_clear = clear_product_cache  # type: ignore
+
+
+def _fetch_product(
+    barcode: str, fields: List[str], server: Union[ServerType, str]
+) -> Optional[Dict]:
     url = get_api_product_url(server) + "/{}.json".format(barcode)
 
     if fields:
@@ -322,6 +391,7 @@ def update_product(
         request_auth = ("off", "off")
 
     r = http_session.get(url, params=params, auth=request_auth, cookies=cookies)
+    invalidate_product_cache(params["code"])
 
     r.raise_for_status()
     json = r.json()
@@ -333,7 +403,7 @@ def update_product(
 
 
 def move_to(barcode: str, to: ServerType) -> bool:
-    if get_product(barcode, server=to) is not None:
+    if get_product(barcode, server=to, use_cache=False) is not None:
         return False
 
     url = "{}/cgi/product_jqm.pl".format(settings.OFF_BASE_WEBSITE_URL)
@@ -344,5 +414,6 @@ def move_to(barcode: str, to: ServerType) -> bool:
         **AUTH_DICT,
     }
     r = http_session.get(url, params=params)
+    invalidate_product_cache(barcode)
     data = r.json()
     return data["status"] == 1
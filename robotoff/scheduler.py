@@ -8,12 +8,14 @@ from apscheduler.events import EVENT_JOB_ERROR
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
+from more_itertools import chunked
 
 from robotoff import slack, settings
 from robotoff.app.core import get_insights
 from robotoff.elasticsearch.category.predict import predict_from_dataset
 from robotoff.insights.annotate import (
-    InsightAnnotatorFactory,
+    annotate_batch,
+    delete_stale_product_snapshots,
     UPDATED_ANNOTATION_RESULT,
 )
 from robotoff.insights.importer import CategoryImporter
@@ -23,7 +25,7 @@ from robotoff.insights.validator import (
     delete_invalid_insight,
 )
 from robotoff.metrics import save_facet_metrics
-from robotoff.models import ProductInsight, db
+from robotoff.models import ProductInsight, db, get_public_data
 from robotoff.products import (
     has_dataset_changed,
     fetch_dataset,
@@ -47,7 +49,7 @@ logger = get_logger(__name__)
 def process_insights():
     processed = 0
     with db:
-        for insight in (
+        insights_iter = (
             ProductInsight.select()
             .where(
                 ProductInsight.annotation.is_null(),
@@ -55,20 +57,23 @@ def process_insights():
                 ProductInsight.process_after <= datetime.datetime.utcnow(),
             )
             .iterator()
-        ):
-            annotator = InsightAnnotatorFactory.get(insight.type)
-            logger.info(
-                "Annotating insight {} (product: {})".format(
-                    insight.id, insight.barcode
+        )
+        for insight_batch in chunked(insights_iter, 100):
+            for insight in insight_batch:
+                logger.info(
+                    "Annotating insight {} (product: {})".format(
+                        insight.id, insight.barcode
+                    )
                 )
-            )
-            annotation_result = annotator.annotate(insight, 1, update=True)
-            processed += 1
 
-            if annotation_result == UPDATED_ANNOTATION_RESULT and insight.data.get(
-                "notify", False
-            ):
-                slack.notify_automatic_processing(insight)
+            annotation_results = annotate_batch(insight_batch, 1, update=True)
+            processed += len(insight_batch)
+
+            for insight, annotation_result in zip(insight_batch, annotation_results):
+                if annotation_result == UPDATED_ANNOTATION_RESULT and insight.data.get(
+                    "notify", False
+                ):
+                    slack.notify_automatic_processing(insight)
 
     logger.info("{} insights processed".format(processed))
 
@@ -235,6 +240,9 @@ def transform_insight_iter(insights_iter: Iterable[Dict]):
             elif isinstance(value, datetime.datetime):
                 insight[field] = value.isoformat()
 
+        if "data" in insight:
+            insight["data"] = get_public_data(insight["data"])
+
         yield insight
 
 
@@ -259,6 +267,9 @@ def run():
         process_insights, "interval", minutes=2, max_instances=1, jitter=20
     )
     scheduler.add_job(mark_insights, "interval", minutes=2, max_instances=1, jitter=20)
+    scheduler.add_job(
+        delete_stale_product_snapshots, "interval", minutes=10, max_instances=1
+    )
     scheduler.add_job(save_facet_metrics, "cron", day="*", hour=1, max_instances=1)
     scheduler.add_job(
         download_product_dataset, "cron", day="*", hour="3", max_instances=1
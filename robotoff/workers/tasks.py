@@ -135,7 +135,7 @@ def delete_product_insights(barcode: str, server_domain: str):
 
 
 def updated_product_update_insights(barcode: str, server_domain: str):
-    product_dict = get_product(barcode)
+    product_dict = get_product(barcode, use_cache=False)
 
     if product_dict is None:
         logger.warn("Updated product does not exist: {}".format(barcode))
@@ -196,7 +196,10 @@ def updated_product_add_category_insight(
     importer = InsightImporterFactory.create(InsightType.category.name, product_store)
 
     imported = importer.import_insights(
-        insights, server_domain=server_domain, automatic=False
+        insights,
+        server_domain=server_domain,
+        automatic=False,
+        products={barcode: product},
     )
 
     if imported:
@@ -220,7 +223,10 @@ def updated_product_predict_insights(
     for insight_type, insights in insights_all.items():
         importer = InsightImporterFactory.create(insight_type, product_store)
         imported = importer.import_insights(
-            [insights], server_domain=server_domain, automatic=False
+            [insights],
+            server_domain=server_domain,
+            automatic=False,
+            products={barcode: product},
         )
 
         if imported:
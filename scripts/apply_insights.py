@@ -6,7 +6,7 @@ from typing import Dict, Optional
 from peewee import fn
 
 from robotoff.insights._enum import InsightType
-from robotoff.insights.annotate import InsightAnnotatorFactory
+from robotoff.insights.annotate import find_annotator
 from robotoff.insights.data import AUTHORIZED_LABELS
 from robotoff.models import ProductInsight
 from robotoff.off import get_product
@@ -134,7 +134,7 @@ def run(insight_type: str, max_timedelta: datetime.timedelta):
     count = 0
     insight: ProductInsight
 
-    annotator = InsightAnnotatorFactory.get(insight_type)
+    annotator = find_annotator(insight_type)
 
     for insight in (
         ProductInsight.select()
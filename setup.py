@@ -21,6 +21,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         "requests>=2.13.0,<3.0.0",
+        "cachetools>=4.0.0,<5.0.0",
         "peewee==3.10.0",
         "psycopg2-binary>=2.8,<2.9",
         "elasticsearch==6.3.1",
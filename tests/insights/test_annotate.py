@@ -0,0 +1,622 @@
+import contextlib
+import datetime
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pytest
+
+from robotoff.insights import annotate
+from robotoff.insights.annotate import (
+    ALREADY_ANNOTATED_RESULT,
+    annotate_batch,
+    ANNOTATORS,
+    BatchAnnotationWriter,
+    create_product_snapshot,
+    UPDATED_ANNOTATION_RESULT,
+    extract_username,
+    find_annotator,
+    get_product_snapshot,
+    InFlightRequests,
+    PackagerCodeAnnotator,
+    PRODUCT_SNAPSHOT_KEY,
+    PRODUCT_SNAPSHOT_TTL,
+    ProductFieldAnnotator,
+    MISSING_PRODUCT_RESULT,
+)
+from robotoff.models import ProductInsight, UserAnnotation
+from robotoff.off import OFFAuthentication
+
+
+@pytest.mark.parametrize(
+    "session_cookie,output",
+    [
+        ("user_session&abcdef&user_id&bob", "bob"),
+        ("user_session&abcdef&user_id&bob&lang&fr", "bob"),
+        ("user_id&bob&user_session&abcdef", "bob"),
+        ("user_session&abcdef&user_id&", None),
+        ("user_session&abcdef&user_id", None),
+        ("user_session&abcdef&user_id&&lang&fr", None),
+        ("user_session&abcdef&other_user_id&bob", None),
+        ("", None),
+    ],
+)
+def test_extract_username(session_cookie: str, output):
+    assert extract_username(session_cookie) == output
+
+
+@pytest.mark.parametrize(
+    "emb_code,emb_codes,output",
+    [
+        ("FR 40.261.001 CE", ["EMB 12345", "fr-40-261-001-ec"], True),
+        ("FR 40.261.001 CE", ["EMB 12345"], False),
+        ("FR 40.261.001 CE", [], False),
+    ],
+)
+def test_packager_code_already_exists(emb_code: str, emb_codes, output: bool):
+    assert PackagerCodeAnnotator.already_exists(emb_code, emb_codes) is output
+
+
+@pytest.mark.parametrize(
+    "check,product,expected_result,expected_field",
+    [
+        (
+            "tag",
+            {"labels_tags": ["en:organic"]},
+            UPDATED_ANNOTATION_RESULT,
+            frozenset(["en:organic", "en:fair-trade"]),
+        ),
+        (
+            "tag",
+            {"labels_tags": ["en:fair-trade"]},
+            ALREADY_ANNOTATED_RESULT,
+            frozenset(["en:fair-trade"]),
+        ),
+        ("filled", {"labels_tags": []}, UPDATED_ANNOTATION_RESULT, "Fair trade"),
+        ("filled", {"labels_tags": "x"}, ALREADY_ANNOTATED_RESULT, "x"),
+        (
+            None,
+            {"labels_tags": ["en:fair-trade"]},
+            UPDATED_ANNOTATION_RESULT,
+            ["en:fair-trade"],
+        ),
+    ],
+)
+def test_product_field_annotator(check, product, expected_result, expected_field):
+    calls = []
+
+    def update_func(barcode, value, **kwargs):
+        calls.append((barcode, value))
+
+    insight = SimpleNamespace(
+        id="1",
+        barcode="123",
+        value="Fair trade",
+        value_tag="en:fair-trade",
+        server_domain="api.openfoodfacts.org",
+    )
+    annotator = ProductFieldAnnotator("labels_tags", update_func, check=check)
+
+    assert annotator.update_product(insight, product=product) == expected_result
+    assert product["labels_tags"] == expected_field
+
+    if expected_result == UPDATED_ANNOTATION_RESULT:
+        assert calls == [("123", "Fair trade")]
+    else:
+        assert calls == []
+
+
+def test_batch_annotation_writer_flush_on_max_size(monkeypatch):
+    flushed = []
+    writer = BatchAnnotationWriter(max_size=2, max_delay=60)
+    monkeypatch.setattr(
+        writer, "flush", lambda: flushed.append(len(writer._buffer)) or 0
+    )
+
+    writer.enqueue("1", "bob", 1)
+    assert flushed == []
+    writer.enqueue("2", None, -1)
+    assert flushed == [2]
+
+
+def test_batch_annotation_writer_default_flush(monkeypatch):
+    flushed = []
+    clock = iter(range(100))
+    # each OFF update sent between two enqueues takes 60 ms
+    monkeypatch.setattr(annotate.time, "monotonic", lambda: next(clock) * 0.06)
+    writer = BatchAnnotationWriter()
+
+    def flush():
+        flushed.append(len(writer._buffer))
+        writer._buffer = {}
+        return 0
+
+    monkeypatch.setattr(writer, "flush", flush)
+
+    with writer:
+        for insight_id in range(10):
+            writer.enqueue(insight_id, None, 1)
+
+    # the annotations are written at once, on exit
+    assert flushed == [10]
+
+
+def test_batch_annotation_writer_queries():
+    writer = BatchAnnotationWriter(max_size=10, max_delay=60)
+    first_id, second_id = uuid.UUID(int=1), uuid.UUID(int=2)
+    completed_at = datetime.datetime(2020, 1, 1)
+    writer.enqueue(first_id, "bob", -1, completed_at)
+    writer.enqueue(second_id, None, 0, completed_at)
+    # the last annotation of an insight wins, its ID is only written once
+    writer.enqueue(first_id, "bob", 1, completed_at)
+
+    update_query, insert_query = writer.build_queries(writer._buffer)
+    sql, params = update_query.sql()
+    assert sql == (
+        'UPDATE "product_insight" SET '
+        '"completed_at" = CASE WHEN ("product_insight"."id" = %s) THEN %s '
+        'WHEN ("product_insight"."id" = %s) THEN %s END, '
+        '"annotation" = CASE WHEN ("product_insight"."id" = %s) THEN %s '
+        'WHEN ("product_insight"."id" = %s) THEN %s END '
+        'WHERE ("product_insight"."id" IN (%s, %s))'
+    )
+    assert params == [
+        first_id.hex,
+        completed_at,
+        second_id.hex,
+        completed_at,
+        first_id.hex,
+        1,
+        second_id.hex,
+        0,
+        first_id.hex,
+        second_id.hex,
+    ]
+
+    sql, params = insert_query.sql()
+    assert sql.startswith(
+        'INSERT INTO "user_annotation" ("insight_id", "username") VALUES (%s, %s)'
+    )
+    assert params == [first_id.hex, "bob"]
+
+
+def test_batch_annotation_writer_flush_error(monkeypatch):
+    calls = mock_annotation_db(monkeypatch, update_error=ValueError("db error"))
+    writer = BatchAnnotationWriter(max_size=10, max_delay=60)
+    writer.enqueue("1", "bob", 1)
+    writer.enqueue("2", None, -1)
+
+    with pytest.raises(ValueError):
+        writer.flush()
+
+    assert calls == ["update"]
+    assert set(writer._buffer) == {"1", "2"}
+
+    monkeypatch.setattr(
+        ProductInsight, "update", lambda *args, **kwargs: FakeQuery(calls, "update")
+    )
+    monkeypatch.setattr(
+        UserAnnotation,
+        "insert_many",
+        lambda *args, **kwargs: FakeQuery(calls, "insert_many"),
+    )
+    assert writer.flush() == 2
+    assert calls == ["update", "update", "insert_many"]
+    assert writer._buffer == {}
+
+
+def test_in_flight_requests(monkeypatch):
+    in_flight = InFlightRequests()
+    started = threading.Event()
+    waiting = threading.Event()
+    calls = []
+
+    class WaitedFuture(annotate.Future):
+        def result(self, timeout=None):
+            waiting.set()
+            return super().result(timeout)
+
+    monkeypatch.setattr(annotate, "Future", WaitedFuture)
+
+    def func(value):
+        calls.append(value)
+        started.set()
+        # return once the second call waits for this one
+        waiting.wait(5)
+        return value
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(in_flight.run, ("123", "labels_tags"), func, 1)
+        started.wait(5)
+        other = in_flight.run(("456", "labels_tags"), lambda: "other")
+        second = executor.submit(in_flight.run, ("123", "labels_tags"), func, 2)
+
+        assert first.result() == 1
+        assert second.result() == 1
+        assert other == "other"
+
+    assert waiting.is_set()
+    assert calls == [1]
+    assert in_flight.run(("123", "labels_tags"), func, 3) == 3
+
+
+def test_send_update_key_includes_auth(monkeypatch):
+    keys = []
+
+    class FakeInFlightRequests:
+        def run(self, key, func, *args, **kwargs):
+            keys.append(key)
+            return UPDATED_ANNOTATION_RESULT
+
+    monkeypatch.setattr(annotate, "_in_flight_updates", FakeInFlightRequests())
+    annotator = ProductFieldAnnotator("labels_tags", lambda *args, **kwargs: None)
+    insight = generate_insight()
+
+    for auth in (
+        None,
+        OFFAuthentication(username="bob", password="pwd"),
+        OFFAuthentication(username="alice", password="pwd"),
+        OFFAuthentication(session_cookie="user_id&bob"),
+        OFFAuthentication(username="bob", password="pwd"),
+    ):
+        annotator._send_update(insight, auth, product=None)
+
+    # updates by different users are never coalesced
+    assert len(set(keys)) == 4
+    assert keys[1] == keys[4]
+
+
+def test_find_annotator():
+    assert find_annotator("label") is ANNOTATORS["label"]
+
+    with pytest.raises(ValueError, match="unknown annotator: foo"):
+        find_annotator("foo")
+
+
+def test_product_snapshot():
+    snapshot = create_product_snapshot(
+        "label", {"code": "123", "labels_tags": ["en:organic"]}
+    )
+    assert snapshot is not None
+    assert snapshot["fields"] == {"labels_tags": ["en:organic"]}
+    assert create_product_snapshot("nutrient", {"code": "123"}) is None
+    # the current emb codes are always fetched from OFF
+    assert create_product_snapshot("packager_code", {"emb_codes": ""}) is None
+
+    insight = SimpleNamespace(data={PRODUCT_SNAPSHOT_KEY: snapshot})
+    assert get_product_snapshot(insight, "labels_tags") == {
+        "labels_tags": ["en:organic"]
+    }
+    assert get_product_snapshot(insight, "categories_tags") is None
+    assert get_product_snapshot(SimpleNamespace(data={}), "labels_tags") is None
+
+    snapshot["fetched_at"] -= PRODUCT_SNAPSHOT_TTL + 1
+    assert get_product_snapshot(insight, "labels_tags") is None
+
+
+class FakeQuery:
+    def __init__(self, calls: List[str], name: str, error: Optional[Exception] = None):
+        self.calls = calls
+        self.name = name
+        self.error = error
+
+    def where(self, *args):
+        return self
+
+    def execute(self):
+        self.calls.append(self.name)
+
+        if self.error is not None:
+            raise self.error
+
+
+class FakeDatabase:
+    def atomic(self):
+        return contextlib.suppress()
+
+
+def mock_annotation_db(monkeypatch, update_error=None, insert_error=None):
+    calls: List[str] = []
+    monkeypatch.setattr(annotate, "db", FakeDatabase())
+    monkeypatch.setattr(
+        ProductInsight,
+        "update",
+        lambda *args, **kwargs: FakeQuery(calls, "update", update_error),
+    )
+    monkeypatch.setattr(
+        UserAnnotation,
+        "insert",
+        lambda *args, **kwargs: FakeQuery(calls, "insert", insert_error),
+    )
+    return calls
+
+
+def generate_insight(**kwargs):
+    data = dict(
+        id="1",
+        barcode="123",
+        type="label",
+        value="Fair trade",
+        value_tag="en:fair-trade",
+        server_domain="api.openfoodfacts.org",
+        data={},
+    )
+    data.update(kwargs)
+    return SimpleNamespace(**data)
+
+
+def test_annotate_sends_update_after_insight_update(monkeypatch):
+    calls = mock_annotation_db(monkeypatch)
+    annotator = ProductFieldAnnotator(
+        "labels_tags", lambda *args, **kwargs: calls.append("off_update")
+    )
+    result = annotator.annotate(
+        generate_insight(),
+        1,
+        auth=OFFAuthentication(username="bob", password="pwd"),
+        product={"labels_tags": []},
+    )
+
+    assert result == UPDATED_ANNOTATION_RESULT
+    assert calls[0] == "update"
+    assert sorted(calls[1:]) == ["insert", "off_update"]
+
+
+def test_annotate_insight_update_error(monkeypatch):
+    calls = mock_annotation_db(monkeypatch, update_error=ValueError("db error"))
+    annotator = ProductFieldAnnotator(
+        "labels_tags", lambda *args, **kwargs: calls.append("off_update")
+    )
+
+    with pytest.raises(ValueError):
+        annotator.annotate(generate_insight(), 1, product={"labels_tags": []})
+
+    assert calls == ["update"]
+
+
+def test_annotate_user_annotation_error_cancels_update(monkeypatch):
+    calls = mock_annotation_db(monkeypatch, insert_error=ValueError("db error"))
+    futures: List[Future] = []
+
+    class QueuedExecutor:
+        """Executor whose tasks never start."""
+
+        def submit(self, func, *args, **kwargs):
+            futures.append(Future())
+            return futures[-1]
+
+    monkeypatch.setattr(annotate, "_product_update_executor", QueuedExecutor())
+    annotator = ProductFieldAnnotator(
+        "labels_tags", lambda *args, **kwargs: calls.append("off_update")
+    )
+
+    with pytest.raises(ValueError):
+        annotator.annotate(
+            generate_insight(),
+            1,
+            auth=OFFAuthentication(username="bob", password="pwd"),
+            product={"labels_tags": []},
+        )
+
+    # the OFF update had not started yet: it is cancelled
+    assert len(futures) == 1
+    assert futures[0].cancelled()
+    assert calls == ["update", "insert"]
+
+
+def test_annotate_user_annotation_error_waits_for_update(monkeypatch):
+    calls = mock_annotation_db(monkeypatch)
+    off_update_started = threading.Event()
+    insert_failed = threading.Event()
+
+    class FailingInsertQuery(FakeQuery):
+        def execute(self):
+            # fail while the OFF update is in progress
+            off_update_started.wait(5)
+            insert_failed.set()
+            super().execute()
+
+    monkeypatch.setattr(
+        UserAnnotation,
+        "insert",
+        lambda *args, **kwargs: FailingInsertQuery(
+            calls, "insert", ValueError("db error")
+        ),
+    )
+
+    def update_func(*args, **kwargs):
+        off_update_started.set()
+        insert_failed.wait(5)
+        calls.append("off_update")
+
+    annotator = ProductFieldAnnotator("labels_tags", update_func)
+
+    with pytest.raises(ValueError):
+        annotator.annotate(
+            generate_insight(),
+            1,
+            auth=OFFAuthentication(username="bob", password="pwd"),
+            product={"labels_tags": []},
+        )
+
+    # the DB error is raised once the running OFF update is over
+    assert calls == ["update", "insert", "off_update"]
+
+
+def mock_annotate_batch(monkeypatch, products):
+    """Mock OFF and the DB for `annotate_batch`, return the `get_product`
+    calls, the OFF updates and the annotations written."""
+    get_product_calls: List = []
+    off_updates: List = []
+    saved: dict = {}
+
+    def get_product(barcode, fields, use_cache=True):
+        get_product_calls.append((barcode, fields))
+        product = products.get(barcode)
+        return None if product is None else dict(product)
+
+    def flush(self):
+        saved.update(self._buffer)
+        self._buffer = {}
+        return 0
+
+    def update_func(barcode, value, **kwargs):
+        off_updates.append((barcode, value))
+
+    monkeypatch.setattr(annotate, "get_product", get_product)
+    monkeypatch.setattr(BatchAnnotationWriter, "flush", flush)
+
+    for insight_type in ("label", "category"):
+        monkeypatch.setattr(ANNOTATORS[insight_type], "update_func", update_func)
+
+    return get_product_calls, off_updates, saved
+
+
+def test_annotate_batch(monkeypatch):
+    get_product_calls, off_updates, saved = mock_annotate_batch(
+        monkeypatch,
+        {
+            "123": {"labels_tags": [], "categories_tags": []},
+            "456": {"labels_tags": ["en:fair-trade"]},
+        },
+    )
+    insights = [
+        generate_insight(id="1", barcode="123"),
+        generate_insight(id="2", barcode="456"),
+        generate_insight(
+            id="3",
+            barcode="123",
+            type="category",
+            value="Teas",
+            value_tag="en:teas",
+        ),
+        generate_insight(id="4", barcode="789"),
+        # same label as insight 1, on the product updated by insight 1
+        generate_insight(id="5", barcode="123"),
+    ]
+
+    results = annotate_batch(insights)
+
+    assert results == [
+        UPDATED_ANNOTATION_RESULT,
+        ALREADY_ANNOTATED_RESULT,
+        UPDATED_ANNOTATION_RESULT,
+        MISSING_PRODUCT_RESULT,
+        ALREADY_ANNOTATED_RESULT,
+    ]
+    # one call per product, requesting the fields of all its insights
+    assert sorted(get_product_calls) == [
+        ("123", ["categories_tags", "labels_tags"]),
+        ("456", ["labels_tags"]),
+        ("789", ["labels_tags"]),
+    ]
+    assert sorted(off_updates) == [("123", "en:fair-trade"), ("123", "en:teas")]
+    # the annotation of the insight with a missing product is saved
+    assert sorted(saved) == ["1", "2", "3", "4", "5"]
+    assert all(annotation == 1 for annotation, _, _ in saved.values())
+
+
+def test_annotate_batch_fetches_replaced_fields_before_update(monkeypatch):
+    events: List = []
+    products = {"123": {"labels_tags": []}, "456": {"emb_codes": "EMB 1"}}
+
+    def get_product(barcode, fields, use_cache=True):
+        events.append(("get_product", barcode, use_cache))
+        return dict(products[barcode])
+
+    def update_func(barcode, value, **kwargs):
+        events.append(("update", barcode))
+
+    mock_annotate_batch(monkeypatch, {})
+    monkeypatch.setattr(annotate, "get_product", get_product)
+    monkeypatch.setattr(ANNOTATORS["label"], "update_func", update_func)
+    monkeypatch.setattr(annotate, "update_emb_codes", update_func)
+
+    results = annotate_batch(
+        [
+            generate_insight(id="1", barcode="123"),
+            generate_insight(
+                id="2", barcode="456", type="packager_code", value="EMB 2"
+            ),
+        ]
+    )
+
+    assert results == [UPDATED_ANNOTATION_RESULT, UPDATED_ANNOTATION_RESULT]
+    # the emb codes are read from OFF right before being overwritten
+    assert events == [
+        ("get_product", "123", True),
+        ("update", "123"),
+        ("get_product", "456", False),
+        ("update", "456"),
+    ]
+
+
+def test_annotate_batch_product_snapshot(monkeypatch):
+    get_product_calls, off_updates, _ = mock_annotate_batch(
+        monkeypatch, {"456": {"labels_tags": []}}
+    )
+    snapshot = create_product_snapshot("label", {"labels_tags": ["en:organic"]})
+    insights = [
+        generate_insight(id="1", barcode="123", data={PRODUCT_SNAPSHOT_KEY: snapshot}),
+        generate_insight(id="2", barcode="456"),
+    ]
+
+    results = annotate_batch(insights)
+
+    assert results == [UPDATED_ANNOTATION_RESULT, UPDATED_ANNOTATION_RESULT]
+    # the product of the first insight is read from its snapshot
+    assert get_product_calls == [("456", ["labels_tags"])]
+    assert sorted(off_updates) == [("123", "en:fair-trade"), ("456", "en:fair-trade")]
+
+
+def test_annotate_batch_concurrent_fetch(monkeypatch):
+    get_product_calls, _, _ = mock_annotate_batch(monkeypatch, {})
+    # fails if the products are not fetched concurrently
+    barrier = threading.Barrier(2, timeout=5)
+
+    def get_product(barcode, fields, use_cache=True):
+        get_product_calls.append(barcode)
+        barrier.wait()
+        return None
+
+    monkeypatch.setattr(annotate, "get_product", get_product)
+    results = annotate_batch(
+        [
+            generate_insight(id="1", barcode="123"),
+            generate_insight(id="2", barcode="456"),
+        ]
+    )
+
+    assert results == [MISSING_PRODUCT_RESULT, MISSING_PRODUCT_RESULT]
+    assert sorted(get_product_calls) == ["123", "456"]
+
+
+@pytest.mark.parametrize(
+    "annotator,use_cache",
+    [
+        (PackagerCodeAnnotator(), False),
+        (ProductFieldAnnotator("quantity", lambda: None, check="filled"), False),
+        (ProductFieldAnnotator("labels_tags", lambda: None), True),
+    ],
+)
+def test_fetch_product_cache(monkeypatch, annotator, use_cache: bool):
+    calls = []
+
+    def get_product(barcode, fields, use_cache=True):
+        calls.append((barcode, fields, use_cache))
+        return {}
+
+    monkeypatch.setattr(annotate, "get_product", get_product)
+    annotator.fetch_product(generate_insight())
+    assert calls == [("123", [annotator.field], use_cache)]
+
+
+def test_insight_serialize_hides_product_snapshot():
+    insight = ProductInsight(
+        id="1", barcode="123", type="label", data={"text": "bio", "_x": {}}
+    )
+    assert insight.serialize(full=True)["data"] == {"text": "bio"}
+    assert "_x" not in insight.serialize()
+    assert insight.serialize()["text"] == "bio"
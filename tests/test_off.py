@@ -0,0 +1,46 @@
+from robotoff import off
+
+
+def test_get_product_cache(monkeypatch):
+    calls = []
+
+    def fetch_product(barcode, fields, server):
+        calls.append((barcode, fields))
+        return {"code": barcode, "labels_tags": ["en:organic"]}
+
+    monkeypatch.setattr(off, "_fetch_product", fetch_product)
+    off.get_product.cache_clear()
+
+    product = off.get_product("123", ["labels_tags"])
+    assert product == {"code": "123", "labels_tags": ["en:organic"]}
+
+    # updating the returned product must not alter the cached value
+    product["labels_tags"] = []
+    assert off.get_product("123", ["labels_tags"]) == {
+        "code": "123",
+        "labels_tags": ["en:organic"],
+    }
+    assert len(calls) == 1
+
+    off.get_product("123", ["categories_tags"])
+    off.get_product("123", ["labels_tags"], use_cache=False)
+    assert len(calls) == 3
+
+    off.get_product("456", ["labels_tags"])
+    assert len(calls) == 4
+
+    off.invalidate_product_cache("123")
+    off.get_product("123", ["labels_tags"])
+    off.get_product("123", ["categories_tags"])
+    off.get_product("456", ["labels_tags"])
+    assert len(calls) == 6
+    off.get_product.cache_clear()
+
+
+def test_http_session_retries():
+    retries = off.http_session.get_adapter(
+        "https://world.openfoodfacts.org"
+    ).max_retries
+    # product updates are GET requests, they must not be sent twice
+    assert retries.read == 0
+    assert retries.total == 3